@@ -1,83 +1,239 @@
 # gym_app.py
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 import json
 from datetime import datetime, date
 from deepface import DeepFace
+import tensorflow as tf
 from PIL import Image
 import smtplib
 from email.message import EmailMessage
 import shutil
+import io
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # -------------------------
 # Config / paths / defaults
 # -------------------------
 st.set_page_config(page_title="Gym Face Entry System", layout="wide")
 
-MEM_FILE = "members.csv"
-ATT_FILE = "attendance.csv"
-DELETED_FILE = "deleted_members.csv"
+MEM_FILE = "members.parquet"
+ATT_FILE = "attendance.parquet"
+DELETED_FILE = "deleted_members.parquet"
 IMG_DIR = "member_images"
 CONFIG_FILE = "config.json"
+# quantized member matrix, memory-mapped at match time; sidecars hold row scales and the row -> ID manifest
+EMB_FILE = "embeddings.i8"   # raw (N, D) int8 rows, appended in place on registration
+EMB_SCALES_FILE = "embedding_scales.f32"   # raw float32 scale per row
+EMB_MANIFEST_FILE = "embeddings.json"   # {"dim": D, "ids": [...]}: row -> member ID
+
+MEM_COLUMNS = ["ID","Name","Gender","Email","Mobile","Membership","Fee","JoinDate","ImagePath"]
+ATT_COLUMNS = ["ID","Name","Date","EntryTime","ExitTime","Status"]
+DELETED_COLUMNS = MEM_COLUMNS + ["DeletedAt"]
+# append-only logs: stored as a directory of Parquet fragments, one per append
+APPEND_TABLES = (ATT_FILE, DELETED_FILE)
+MAX_FRAGMENTS = 64   # fragments per log before appends compact it into one file
 
 os.makedirs(IMG_DIR, exist_ok=True)
 
 # Recognition model + threshold
 RECOGNITION_MODEL = "VGG-Face"
 DISTANCE_THRESHOLD = 0.6   # adjust if needed (higher -> more permissive)
+MATCH_CHUNK = 32   # members compared per step, most recently seen first
+EMBED_WORKERS = 2   # concurrent embeddings on a cold cache; TensorFlow already uses every core per call
 
 # -------------------------
-# CSV initialization helpers
+# Storage helpers (Parquet)
 # -------------------------
-def ensure_csv_files():
-    if not os.path.exists(MEM_FILE):
-        pd.DataFrame(columns=["ID","Name","Gender","Email","Mobile","Membership","Fee","JoinDate","ImagePath"]).to_csv(MEM_FILE, index=False)
-    if not os.path.exists(ATT_FILE):
-        pd.DataFrame(columns=["ID","Name","Date","EntryTime","ExitTime","Status"]).to_csv(ATT_FILE, index=False)
-    if not os.path.exists(DELETED_FILE):
-        pd.DataFrame(columns=["ID","Name","Gender","Email","Mobile","Membership","Fee","JoinDate","ImagePath","DeletedAt"]).to_csv(DELETED_FILE, index=False)
+def write_frame(df, path):
+    # every column is stored as string, same as the old dtype=str CSVs
+    df.astype("string[pyarrow]").fillna("").to_parquet(path, compression="snappy", index=False)
 
-def load_members():
-    ensure_csv_files()
-    df = pd.read_csv(MEM_FILE, dtype=str).fillna("")
-    # keep ID column as string for safe comparisons
-    if "ID" not in df.columns:
-        df["ID"] = ""
-    return df
+def fragment_paths(path):
+    return sorted(e.path for e in os.scandir(path) if e.name.endswith(".parquet") and not e.name.startswith("."))
 
-def save_members(df):
-    df.to_csv(MEM_FILE, index=False)
+def new_fragment(path):
+    # zero-padded so fragments sort (and read back) in append order; the uuid keeps two
+    # appends within one clock tick (~15 ms on older Windows Pythons) from sharing a name
+    return os.path.join(path, f"part-{time.time_ns():020d}-{uuid.uuid4().hex}.parquet")
 
-def load_attendance():
-    ensure_csv_files()
-    df = pd.read_csv(ATT_FILE, dtype=str).fillna("")
-    for c in ["ID","Name","Date","EntryTime","ExitTime","Status"]:
+def write_fragment(df, path):
+    """
+    Adds df to the fragment directory at path; the part file appears complete or not at all
+    """
+    part_path = new_fragment(path)
+    # dot-prefixed names are skipped by pyarrow's dataset discovery until renamed
+    tmp_path = os.path.join(path, "." + os.path.basename(part_path) + ".tmp")
+    write_frame(df, tmp_path)
+    os.replace(tmp_path, part_path)
+
+@st.cache_resource(show_spinner=False)
+def get_table_lock():
+    """
+    Process-wide lock so no session reads a fragment directory while another swaps it
+    """
+    return threading.RLock()
+
+def recover_table(path):
+    """
+    Finishes a swap_table_dir interrupted by a crash (<path>.new only ever holds a complete
+    table) and removes temp files of interrupted appends
+    """
+    tmp_dir, new_dir, old_dir = path + ".tmp", path + ".new", path + ".old"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    if os.path.isdir(new_dir):
+        if os.path.exists(path) and not os.path.exists(old_dir):
+            os.replace(path, old_dir)
+        os.replace(new_dir, path)
+    if os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.isdir(path):
+        # half-written appends from a crash
+        for e in os.scandir(path):
+            if e.name.startswith("."):
+                os.remove(e.path)
+
+def swap_table_dir(df, path):
+    """
+    Replaces the fragment directory at path with a single compacted fragment.
+    Old and new fragments never share a directory, so a reader sees one table or the other.
+    """
+    tmp_dir, new_dir, old_dir = path + ".tmp", path + ".new", path + ".old"
+    recover_table(path)
+    os.makedirs(tmp_dir)
+    write_frame(df, new_fragment(tmp_dir))
+    os.replace(tmp_dir, new_dir)
+    if os.path.exists(path):
+        os.replace(path, old_dir)
+    os.replace(new_dir, path)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def write_table(df, path):
+    with get_table_lock():
+        if path in APPEND_TABLES:
+            swap_table_dir(df, path)
+        else:
+            write_frame(df, path)
+    # mtime alone can miss two writes within one timestamp tick
+    read_table_cached.clear()
+    drop_session_table(path)
+
+def append_table(rows, path, columns):
+    """
+    Adds rows (list of dicts) to an append-only table as a new fragment instead of rewriting it
+    """
+    df = pd.DataFrame(rows, columns=columns)
+    with get_table_lock():
+        if len(fragment_paths(path)) >= MAX_FRAGMENTS:
+            write_table(pd.concat([read_table(path, columns), df], ignore_index=True), path)
+            return
+        write_fragment(df, path)
+    read_table_cached.clear()
+    drop_session_table(path)
+
+def read_table(path, columns):
+    df = pd.read_parquet(path).astype("string[pyarrow]").fillna("")
+    for c in columns:
         if c not in df.columns:
             df[c] = ""
     return df
 
-def save_attendance(df):
-    df.to_csv(ATT_FILE, index=False)
-def load_deleted():
-    ensure_csv_files()
+@st.cache_data(show_spinner=False)
+def read_table_cached(path, mtime, columns):
+    """
+    read_table memoized per file version; mtime only serves as part of the cache key
+    """
+    return read_table(path, columns)
+
+def session_table(path, loader):
+    """
+    loader() result kept in st.session_state so fragment reruns reuse the same frame;
+    reloaded when path's mtime changes (writes from any session), and dropped on this
+    session's writes and on the View pages' Reload buttons
+    """
+    tables = st.session_state.setdefault("tables", {})
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    if path not in tables or tables[path][0] != mtime:
+        # keyed on the mtime seen before loading, so a write racing the load triggers another
+        tables[path] = (mtime, loader())
+    return tables[path][1]
+
+def drop_session_table(path):
+    st.session_state.get("tables", {}).pop(path, None)
+
+def load_table(path, columns):
+    with get_table_lock():
+        ensure_data_files()
+        return read_table_cached(path, os.path.getmtime(path), columns)
+
+def migrate_csv(path, columns):
+    """
+    One-time move from the old <name>.csv file to <name>.parquet
+    """
+    csv_path = os.path.splitext(path)[0] + ".csv"
+    if os.path.exists(path) or not os.path.exists(csv_path):
+        return
     try:
-        df = pd.read_csv(DELETED_FILE, dtype=str).fillna("")
-        if df.empty or df.columns.tolist() == [""]:
-            raise Exception("Empty file")
-        return df
-    except:
-        # recreate file with correct columns
-        df = pd.DataFrame(columns=[
-            "ID","Name","Gender","Email","Mobile",
-            "Membership","Fee","JoinDate","ImagePath","DeletedAt"
-        ])
-        df.to_csv(DELETED_FILE, index=False)
-        return df
+        df = pd.read_csv(csv_path, dtype=str).fillna("")
+    except pd.errors.EmptyDataError:
+        # zero-byte CSV: start from a clean table
+        df = pd.DataFrame(columns=columns)
+    except Exception as e:
+        # never drop the only copy of the data because it failed to parse
+        raise RuntimeError(f"Could not migrate {csv_path} to {path}: {e}. The CSV was left in place; fix or re-save it as UTF-8 and reload.") from e
+    write_table(df, path)
+    os.remove(csv_path)
+
+def migrate_dataset(path):
+    """
+    One-time move of a single-file append-only table into its fragment directory
+    """
+    if path not in APPEND_TABLES or not os.path.isfile(path):
+        return
+    tmp_path = path + ".tmp"
+    os.replace(path, tmp_path)
+    os.makedirs(path)
+    os.replace(tmp_path, new_fragment(path))
+
+def ensure_data_files():
+    with get_table_lock():
+        for path, columns in ((MEM_FILE, MEM_COLUMNS), (ATT_FILE, ATT_COLUMNS), (DELETED_FILE, DELETED_COLUMNS)):
+            if path in APPEND_TABLES:
+                recover_table(path)
+            migrate_csv(path, columns)
+            migrate_dataset(path)
+            if not os.path.exists(path):
+                write_table(pd.DataFrame(columns=columns), path)
+
+def load_members():
+    # keep ID column as string for safe comparisons; also index by it for O(1) .loc lookups
+    return load_table(MEM_FILE, MEM_COLUMNS).set_index("ID", drop=False).rename_axis(None)
+
+def save_members(df):
+    write_table(df, MEM_FILE)
+
+def load_attendance():
+    return load_table(ATT_FILE, ATT_COLUMNS)
+
+def save_attendance(df):
+    write_table(df, ATT_FILE)
 
+def append_attendance(row):
+    append_table([row], ATT_FILE, ATT_COLUMNS)
 
-def save_deleted(df):
-    df.to_csv(DELETED_FILE, index=False)
+def append_deleted(row):
+    append_table([row], DELETED_FILE, DELETED_COLUMNS)
 
 # -------------------------
 # Config load/save (SMTP)
@@ -100,6 +256,67 @@ cfg = load_config()
 # -------------------------
 # Email util
 # -------------------------
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+SMTP_MAX_MESSAGES = 50   # messages per connection before reconnecting
+
+def open_smtp(admin_email, admin_pass):
+    smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20)
+    smtp.ehlo()
+    smtp.starttls()
+    smtp.login(admin_email, admin_pass)
+    return smtp
+
+def smtp_alive(smtp):
+    try:
+        return smtp.noop()[0] == 250
+    except Exception:
+        return False
+
+def close_smtp(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        pass
+
+def mail_worker(outbox, failures):
+    """
+    Sends queued (msg, (admin_email, admin_pass)) items over one long-lived SMTP connection
+    """
+    smtp, smtp_creds, sent = None, None, 0
+    while True:
+        msg, creds = outbox.get()
+        for attempt in range(2):
+            try:
+                if smtp is not None and (creds != smtp_creds or sent >= SMTP_MAX_MESSAGES or not smtp_alive(smtp)):
+                    close_smtp(smtp)
+                    smtp = None
+                if smtp is None:
+                    smtp, smtp_creds, sent = open_smtp(*creds), creds, 0
+                else:
+                    smtp.rset()
+                smtp.send_message(msg)
+                sent += 1
+                break
+            except Exception as e:
+                # connection may be half-open: reconnect and retry once
+                if smtp is not None:
+                    close_smtp(smtp)
+                smtp = None
+                if attempt:
+                    failures.append(f"{msg['To']} ({msg['Subject']}): {e}")
+        outbox.task_done()
+
+@st.cache_resource(show_spinner=False)
+def get_mail_worker():
+    """
+    Starts the background sender once per process; returns (outbox queue, recent failures)
+    """
+    outbox = queue.Queue()
+    failures = deque(maxlen=20)
+    threading.Thread(target=mail_worker, args=(outbox, failures), daemon=True).start()
+    return outbox, failures
+
 def send_email_using_config(to_email, subject, body):
     cfg_local = load_config()
     admin_email = cfg_local.get("admin_email")
@@ -112,75 +329,421 @@ def send_email_using_config(to_email, subject, body):
         msg["From"] = admin_email
         msg["To"] = to_email
         msg.set_content(body)
-        with smtplib.SMTP("smtp.gmail.com", 587, timeout=20) as smtp:
-            smtp.ehlo()
-            smtp.starttls()
-            smtp.login(admin_email, admin_pass)
-            smtp.send_message(msg)
-        return True, "Email sent"
+        outbox, _ = get_mail_worker()
+        outbox.put((msg, (admin_email, admin_pass)))
+        return True, "Email queued"
     except Exception as e:
         return False, str(e)
 
 # -------------------------
-# Face verification helper
+# Face embedding helpers
 # -------------------------
-def try_verify_faces(img1_path, img2_path):
+def embedding_path(img_path):
+    return img_path + ".npy"
+
+def normalize(vec):
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def decode_image(uploaded_file):
     """
-    Returns (match_bool, distance_or_none, details)
+    Camera upload as a BGR uint8 array, the channel order DeepFace expects for in-memory images
+    """
+    rgb = np.asarray(Image.open(io.BytesIO(uploaded_file.getvalue())).convert("RGB"))
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+@st.cache_resource(show_spinner=False)
+def get_face_device():
+    """
+    TensorFlow device for face inference: "/GPU:0" when a GPU is visible, else "/CPU:0"
+    """
+    gpus = tf.config.list_physical_devices("GPU")
+    for gpu in gpus:
+        try:
+            # allocate GPU memory as needed instead of reserving all of it up front
+            tf.config.experimental.set_memory_growth(gpu, True)
+        except RuntimeError:
+            pass   # GPU already initialized; keep TensorFlow's allocation policy
+    return "/GPU:0" if gpus else "/CPU:0"
+
+@st.cache_resource(show_spinner="Loading face recognition model...")
+def get_face_model():
+    """
+    Builds RECOGNITION_MODEL once per process so its weights survive Streamlit reruns.
+    DeepFace.represent resolves models through DeepFace.build_model, which hands back this instance.
+    """
+    with tf.device(get_face_device()):
+        return DeepFace.build_model(RECOGNITION_MODEL)
+
+def embed_image(img_path, device):
+    """
+    DeepFace.represent on an already-built model, placed on device
+    """
+    with tf.device(device):
+        res = DeepFace.represent(img_path=img_path, model_name=RECOGNITION_MODEL, enforce_detection=False)
+    return np.asarray(res[0]["embedding"], dtype=np.float32)
+
+def compute_embedding(img_path):
+    """
+    Returns the raw RECOGNITION_MODEL embedding (float32 vector) of the face in img_path
+    (a file path or a decode_image() array)
+    """
+    get_face_model()
+    return embed_image(img_path, get_face_device())
+
+def embed_and_store(img_path, device):
+    vec = embed_image(img_path, device)
+    np.save(embedding_path(img_path), vec)
+    return vec
+
+def scan_images():
+    """
+    {file name: os.DirEntry} for every file in IMG_DIR, from a single directory read
     """
     try:
-        res = DeepFace.verify(img1_path=img1_path, img2_path=img2_path, model_name=RECOGNITION_MODEL, enforce_detection=False)
-        verified = bool(res.get("verified", False))
-        distance = None
-        for k in ("distance","cosine","euclidean"):
-            if k in res:
-                try:
-                    distance = float(res[k])
-                    break
-                except Exception:
-                    continue
-        if distance is not None:
-            match = distance <= DISTANCE_THRESHOLD
+        return {e.name: e for e in os.scandir(IMG_DIR)}
+    except FileNotFoundError:
+        return {}
+
+def listed_entry(path, present):
+    """
+    scan_images() entry for path if it names a listed file in IMG_DIR, else None
+    """
+    # normpath so "member_images/x.jpg" and "member_images\\x.jpg" rows both match on Windows
+    norm = os.path.normpath(path)
+    if os.path.dirname(norm) != os.path.normpath(IMG_DIR):
+        return None
+    return present.get(os.path.basename(norm))
+
+def file_exists(path, present):
+    # anything not in the listing (other dirs, files added since the scan) is stat'ed
+    return listed_entry(path, present) is not None or os.path.exists(path)
+
+def file_mtime(path, present):
+    """
+    mtime of path or None if missing, using the scan_images() listing where it can
+    """
+    entry = listed_entry(path, present)
+    if entry is not None:
+        return entry.stat().st_mtime
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+def member_embedding_entries(members):
+    """
+    Cache key for load_member_embeddings: (ID, ImagePath, embedding mtime) per member
+    whose photo exists; mtime is 0.0 when the embedding has not been stored yet
+    """
+    present = scan_images()
+    has_image = members["ImagePath"].map(lambda p: bool(p) and file_exists(p, present))
+    members = members[has_image]
+    entries = []
+    for member_id, img_path in zip(members["ID"].astype(str), members["ImagePath"]):
+        mtime = file_mtime(embedding_path(img_path), present)
+        entries.append((member_id, img_path, mtime or 0.0))
+    return tuple(entries)
+
+def quantize_rows(E):
+    """
+    Per-row symmetric int8 quantization: E ~= E_i8 * scales[:, None]
+    """
+    scales = np.abs(E).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    E_i8 = np.round(E / scales[:, None]).astype(np.int8)
+    return E_i8, scales.astype(np.float32)
+
+def write_atomic(path, write):
+    """
+    Calls write(f) on a uniquely named temp file, then moves it over path in one step
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def read_manifest():
+    with open(EMB_MANIFEST_FILE, "r") as f:
+        return json.load(f)
+
+def write_manifest(dim, ids):
+    # last step of every matrix write: its mtime vouches for the rows before it
+    write_atomic(EMB_MANIFEST_FILE, lambda f: f.write(json.dumps({"dim": dim, "ids": ids}).encode("utf-8")))
+
+def map_member_matrix(manifest):
+    """
+    (E_i8, scales) memory-mapped read-only for the rows listed in manifest; bytes past them are ignored
+    """
+    n, dim = len(manifest["ids"]), manifest["dim"]
+    E_i8 = np.memmap(EMB_FILE, dtype=np.int8, mode="r", shape=(n, dim))
+    scales = np.memmap(EMB_SCALES_FILE, dtype=np.float32, mode="r", shape=(n,))
+    return E_i8, scales
+
+def stored_member_matrix(entries):
+    """
+    (ids, E_i8, scales) mapped from EMB_FILE if EMB_MANIFEST_FILE was written after every
+    member embedding in entries and covers the same IDs; None otherwise
+    """
+    if not entries or not all(emb_mtime for _, _, emb_mtime in entries):
+        return None
+    try:
+        if os.path.getmtime(EMB_MANIFEST_FILE) < max(emb_mtime for _, _, emb_mtime in entries):
+            return None
+        manifest = read_manifest()
+        if manifest["ids"] != [member_id for member_id, _, _ in entries]:
+            return None
+        return (manifest["ids"],) + map_member_matrix(manifest)
+    except Exception:
+        return None
+
+def store_member_embedding(member_id, vec):
+    """
+    Writes one member's row into the stored matrix: overwritten in place if the member
+    already has one, appended otherwise. Without a usable matrix this does nothing and the
+    next load_member_embeddings rebuilds it from the per-member files.
+    """
+    with get_table_lock():
+        try:
+            manifest = read_manifest()
+        except Exception:
+            return
+        ids, dim = manifest["ids"], manifest["dim"]
+        if vec.shape != (dim,):
+            return
+        row_i8, row_scale = quantize_rows(normalize(vec).reshape(1, dim).astype(np.float32))
+        if member_id in ids:
+            i = ids.index(member_id)
+            for path, dtype, shape, row in ((EMB_FILE, np.int8, (len(ids), dim), row_i8[0]),
+                                            (EMB_SCALES_FILE, np.float32, (len(ids),), row_scale[0])):
+                m = np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+                m[i] = row
+                m.flush()
+                del m
         else:
-            match = verified
-        return match, distance, res
-    except Exception as e:
-        return False, None, {"error": str(e)}
+            for path, row in ((EMB_FILE, row_i8), (EMB_SCALES_FILE, row_scale)):
+                with open(path, "r+b") as f:
+                    size = len(ids) * row.nbytes
+                    if os.fstat(f.fileno()).st_size != size:
+                        f.truncate(size)   # drop a partial row left by an interrupted append
+                    f.seek(size)
+                    f.write(row.tobytes())
+            ids = ids + [member_id]
+        write_manifest(dim, ids)
+
+# one entry: each membership change makes a new key, and older matrices are never reused
+@st.cache_resource(max_entries=1, show_spinner="Loading member face embeddings...")
+def load_member_embeddings(entries):
+    """
+    Returns (ids, E_i8, scales): the L2-normalized (N, D) member matrix quantized to int8
+    with one float32 scale per row (row i belonging to ids[i]), memory-mapped from
+    EMB_FILE / EMB_SCALES_FILE so only the rows a match touches are paged in.
+    Registration and photo updates write their row through store_member_embedding; the
+    matrix is rebuilt from the per-member files only when it no longer matches entries.
+    Members without a stored embedding are embedded once from their photo, EMBED_WORKERS at a time.
+    """
+    stored = stored_member_matrix(entries)
+    if stored is not None:
+        return stored
+    missing = [img_path for _, img_path, emb_mtime in entries if not emb_mtime]
+    computed = {}
+    if missing:
+        get_face_model()   # build before the workers share it
+        device = get_face_device()
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as ex:
+            # the first call also builds DeepFace's face detector; let it finish before the rest share it
+            first = ex.submit(embed_and_store, missing[0], device)
+            first.exception()
+            computed = {missing[0]: first}
+            computed.update((p, ex.submit(embed_and_store, p, device)) for p in missing[1:])
+    ids, vecs = [], []
+    for member_id, img_path, emb_mtime in entries:
+        try:
+            vec = np.load(embedding_path(img_path)) if emb_mtime else computed[img_path].result()
+        except Exception:
+            continue
+        ids.append(member_id)
+        vecs.append(normalize(vec))
+    if not vecs:
+        return ids, np.empty((0, 0), dtype=np.int8), np.empty(0, dtype=np.float32)
+    E_i8, scales = quantize_rows(np.vstack(vecs).astype(np.float32))
+    with get_table_lock():
+        write_atomic(EMB_FILE, E_i8.tofile)
+        write_atomic(EMB_SCALES_FILE, scales.tofile)
+        write_manifest(E_i8.shape[1], ids)
+        manifest = read_manifest()
+    return (manifest["ids"],) + map_member_matrix(manifest)
+
+def recency_order(ids):
+    """
+    Positions into ids ordered by last attendance, most recent first (never seen last)
+    """
+    with get_table_lock():
+        att_mtime = os.path.getmtime(ATT_FILE)
+    return recency_order_cached(tuple(ids), att_mtime)
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def recency_order_cached(ids, att_mtime):
+    """
+    recency_order memoized per member list and attendance version; att_mtime only serves as part of the cache key
+    """
+    attendance = load_attendance()
+    last_seen = (attendance["Date"] + " " + attendance["EntryTime"]).groupby(attendance["ID"]).max()
+    seen = pd.Series(ids).map(last_seen).fillna("")
+    return seen.sort_values(ascending=False, kind="stable").index.to_numpy()
+
+def match_face(probe, members):
+    """
+    Returns (row, distance) of the closest member by cosine distance, or None.
+    Members are scanned MATCH_CHUNK at a time, regulars first, stopping at the first
+    chunk that holds a match within DISTANCE_THRESHOLD.
+    """
+    ids, E_i8, scales = load_member_embeddings(member_embedding_entries(members))
+    if not ids:
+        return None
+    try:
+        q = normalize(compute_embedding(probe))
+    except Exception:
+        return None
+    order = recency_order(ids)
+    best_idx, best_dist = None, None
+    for start in range(0, len(order), MATCH_CHUNK):
+        chunk = order[start:start + MATCH_CHUNK]
+        dists = 1.0 - (E_i8[chunk] @ q) * scales[chunk]
+        i = int(dists.argmin())
+        if best_dist is None or dists[i] < best_dist:
+            best_idx, best_dist = int(chunk[i]), float(dists[i])
+        if best_dist <= DISTANCE_THRESHOLD:
+            break
+    row = members.loc[ids[best_idx]]
+    return row, best_dist
 
 # -------------------------
 # ID generator (unique)
 # -------------------------
-def generate_member_id():
-    members = load_members()
+def generate_member_id(members=None):
+    if members is None:
+        members = load_members()
     if members.empty:
         return "1"
-    # find numeric IDs and take max + 1
-    nums = []
-    for v in members["ID"].astype(str).tolist():
-        try:
-            nums.append(int(v))
-        except:
-            continue
-    if not nums:
-        return "1"
-    return str(max(nums) + 1)
+    # find integer IDs and take max + 1; "inf", "1e3", "2.5" etc. are skipped like int() did,
+    # and at most 18 digits keeps every match exact in int64
+    ids = members["ID"].astype(str).str.strip()
+    ints = ids[ids.str.fullmatch(r"[+-]?[0-9]{1,18}")]
+    m = pd.to_numeric(ints, errors="coerce").astype("Int64").max()
+    return "1" if pd.isna(m) else str(int(m) + 1)
+
+# -------------------------
+# Attendance timestamps
+# -------------------------
+def now_date_time():
+    """
+    Current ("YYYY-MM-DD", "HH:MM:SS") from one ISO format call
+    """
+    return tuple(datetime.now().isoformat(sep=" ", timespec="seconds").split(" "))
 
 # -------------------------
 # Save image helper
 # -------------------------
+def write_jpeg(uploaded_file, path):
+    """
+    Saves an upload (or raw bytes) to path as JPEG; JPEG input is written verbatim
+    """
+    data = uploaded_file if isinstance(uploaded_file, bytes) else uploaded_file.getvalue()
+    if data[:3] == b"\xff\xd8\xff":
+        with open(path, "wb") as f:
+            f.write(data)
+    else:
+        Image.open(io.BytesIO(data)).convert("RGB").save(path, format="JPEG", quality=90)
+
 def save_member_image(uploaded_file, member_id, name):
     safe_name = "".join(c for c in name if c.isalnum() or c in (" ", "_")).strip().replace(" ", "_")
     filename = f"{member_id}_{safe_name}.jpg"
     path = os.path.join(IMG_DIR, filename)
+    write_jpeg(uploaded_file, path)
+    # embed once at save time so Entry/Exit only has to embed the probe
+    emb_path = embedding_path(path)
     try:
-        img = Image.open(uploaded_file).convert("RGB")
-        img.save(path, format="JPEG", quality=90)
-    except Exception as e:
-        # If uploaded_file is bytes
-        with open(path, "wb") as f:
-            f.write(uploaded_file)
+        vec = compute_embedding(path)
+        np.save(emb_path, vec)
+    except Exception:
+        # drop a stale embedding; load_member_embeddings retries from the photo
+        if os.path.exists(emb_path):
+            os.remove(emb_path)
+        return path
+    store_member_embedding(str(member_id), vec)
     return path
 
+# -------------------------
+# View pages (fragments)
+# -------------------------
+@st.fragment
+def view_members():
+    """
+    Members table with filters; typing in a filter reruns only this fragment
+    """
+    if st.button("Reload members"):
+        drop_session_table(MEM_FILE)
+    members = session_table(MEM_FILE, load_members)
+    if members.empty:
+        st.warning("No members registered.")
+    else:
+        c1, c2, c3 = st.columns([1,1,1])
+        with c1:
+            id_filter = st.text_input("Filter by ID (exact)")
+        with c2:
+            name_filter = st.text_input("Search Name (partial)")
+        with c3:
+            phone_filter = st.text_input("Search Mobile (partial)")
+
+        # low-cardinality columns as categories; astype also gives us our own copy
+        df = members.astype({"Gender": "category", "Membership": "category"})
+        if id_filter:
+            df = df[df["ID"].eq(id_filter)]
+        if name_filter:
+            df = df[df["Name"].str.contains(name_filter, case=False, regex=False, na=False)]
+        if phone_filter:
+            df = df[df["Mobile"].str.contains(phone_filter, regex=False, na=False)]
+
+        if df.empty:
+            st.info("No matching members.")
+        else:
+            st.dataframe(df, hide_index=True)
+            csv = df.to_csv(index=False).encode("utf-8")
+            st.download_button("Download Members CSV", data=csv, file_name="members_filtered.csv", mime="text/csv")
+
+@st.fragment
+def view_attendance():
+    """
+    Attendance log with filters; typing in a filter reruns only this fragment
+    """
+    if st.button("Reload attendance"):
+        drop_session_table(ATT_FILE)
+    attendance = session_table(ATT_FILE, load_attendance)
+    if attendance.empty:
+        st.warning("No attendance records.")
+    else:
+        c1, c2, c3 = st.columns([1,1,1])
+        with c1:
+            date_filter = st.date_input("Filter by Date", value=None)
+            # To allow none, if user doesn't set date we treat as all
+        with c2:
+            id_filter = st.text_input("Filter by ID")
+        with c3:
+            name_filter = st.text_input("Filter by Name")
+
+        df = attendance   # filters below build new frames; the session copy is never mutated
+        if date_filter:
+            df = df[df["Date"] == str(date_filter)]
+        if id_filter:
+            df = df[df["ID"].eq(id_filter)]
+        if name_filter:
+            df = df[df["Name"].str.contains(name_filter, case=False, regex=False, na=False)]
+
+        if df.empty:
+            st.info("No matching attendance records.")
+        else:
+            st.dataframe(df)
+            csv = df.to_csv(index=False).encode("utf-8")
+            st.download_button("Download Attendance CSV", data=csv, file_name="attendance_filtered.csv", mime="text/csv")
+
 # -------------------------
 # Sidebar: SMTP config & menu
 # -------------------------
@@ -195,12 +758,21 @@ with st.sidebar.expander("SMTP Settings (one-time)", expanded=False):
             save_config({"admin_email": admin_email, "admin_pass": admin_pass})
             st.success("SMTP settings saved locally to config.json")
 
+_, mail_failures = get_mail_worker()
+if mail_failures:
+    with st.sidebar.expander(f"Email failures ({len(mail_failures)})", expanded=False):
+        for f in list(mail_failures):
+            st.write(f)
+        if st.button("Clear email failures"):
+            mail_failures.clear()
+            st.rerun()
+
 st.sidebar.markdown("---")
 menu = st.sidebar.radio("Navigation", ["Register Member", "Update / Delete Member", "Attendance - Entry", "Attendance - Exit", "View Members", "View Attendance", "Reset DB"])
 
 st.title("Gym Face Entry System")
 
-ensure_csv_files()
+ensure_data_files()
 
 # -------------------------
 # 1) Register Member
@@ -225,9 +797,9 @@ if menu == "Register Member":
             st.warning("Please fill Name, Email, Mobile and capture a photo.")
         else:
             members = load_members()
-            member_id = id_input.strip() if id_input.strip() else generate_member_id()
+            member_id = id_input.strip() if id_input.strip() else generate_member_id(members)
             # ensure unique
-            if member_id in members["ID"].astype(str).values:
+            if member_id in members.index:
                 st.error("Member ID already exists. Choose different ID or leave blank for auto ID.")
             else:
                 # save image
@@ -247,7 +819,7 @@ if menu == "Register Member":
                     "JoinDate": str(join_date),
                     "ImagePath": img_path
                 }
-                members = pd.concat([members, pd.DataFrame([new_row])], ignore_index=True)
+                members = pd.concat([members, pd.DataFrame([new_row], index=[member_id])])
                 save_members(members)
                 st.success(f"Member registered: {name} (ID: {member_id})")
                 # send email if configured
@@ -255,7 +827,7 @@ if menu == "Register Member":
                 body = f"Hello {name},\n\nYour registration is successful.\nMember ID: {member_id}\nMembership: {membership}\nFee: ₹{fee}\nJoin Date: {join_date}\n\nRegards,\nGym Team"
                 sent, info = send_email_using_config(email, subject, body)
                 if sent:
-                    st.info("Registration email sent to member.")
+                    st.info("Registration email queued for member.")
                 else:
                     st.warning(f"Registration saved but email not sent: {info}")
 
@@ -268,9 +840,9 @@ elif menu == "Update / Delete Member":
     if members.empty:
         st.warning("No members available.")
     else:
-        sel_id = st.selectbox("Select Member ID", options=["--select--"] + members["ID"].astype(str).tolist())
+        sel_id = st.selectbox("Select Member ID", options=["--select--"] + members.index.tolist())
         if sel_id and sel_id != "--select--":
-            member = members[members["ID"].astype(str) == sel_id].iloc[0]
+            member = members.loc[sel_id]
             st.markdown(f"**Member:** {member['Name']}  •  **Email:** {member['Email']}")
             with st.form("update_form"):
                 name = st.text_input("Name", member["Name"])
@@ -289,7 +861,7 @@ elif menu == "Update / Delete Member":
                         img_path = save_member_image(new_photo, sel_id, name)
                     except Exception as e:
                         st.warning(f"Could not save new photo: {e}")
-                members.loc[members["ID"].astype(str) == sel_id, ["Name","Gender","Email","Mobile","Membership","Fee","JoinDate","ImagePath"]] = [name,gender,email,mobile,membership,str(fee),str(join_date),img_path]
+                members.loc[sel_id, ["Name","Gender","Email","Mobile","Membership","Fee","JoinDate","ImagePath"]] = [name,gender,email,mobile,membership,str(fee),str(join_date),img_path]
                 save_members(members)
                 st.success("Member updated.")
                 # notify
@@ -297,25 +869,25 @@ elif menu == "Update / Delete Member":
                 bod = f"Hello {name},\n\nYour membership details have been updated.\nMember ID: {sel_id}\nMembership: {membership}\nFee: ₹{fee}\n\nRegards,\nGym Team"
                 s, i = send_email_using_config(email, sub, bod)
                 if s:
-                    st.info("Update email sent.")
+                    st.info("Update email queued.")
                 else:
                     st.warning(f"Update saved but email not sent: {i}")
 
             if st.button("Delete Member (permanent)"):
                 # backup row
-                row = members[members["ID"].astype(str) == sel_id].iloc[0].to_dict()
-                deleted = load_deleted()
+                row = members.loc[sel_id].to_dict()
                 row["DeletedAt"] = str(datetime.now())
-                deleted = pd.concat([deleted, pd.DataFrame([row])], ignore_index=True)
-                save_deleted(deleted)
-                # delete image
+                append_deleted(row)
+                # delete image and its embedding
                 try:
-                    if row.get("ImagePath") and os.path.exists(row["ImagePath"]):
-                        os.remove(row["ImagePath"])
+                    if row.get("ImagePath"):
+                        for p in (row["ImagePath"], embedding_path(row["ImagePath"])):
+                            if os.path.exists(p):
+                                os.remove(p)
                 except Exception:
                     pass
                 # delete member row
-                members = members[members["ID"].astype(str) != sel_id]
+                members = members.drop(index=sel_id)
                 save_members(members)
                 # delete attendance rows
                 attendance = load_attendance()
@@ -327,7 +899,7 @@ elif menu == "Update / Delete Member":
                 bod = f"Hello {row.get('Name','')},\n\nYour membership (ID: {sel_id}) has been deleted.\n\nRegards,\nGym Team"
                 s, i = send_email_using_config(row.get("Email",""), sub, bod)
                 if s:
-                    st.info("Deletion email sent.")
+                    st.info("Deletion email queued.")
                 else:
                     st.warning(f"Deletion done but email not sent: {i}")
 
@@ -336,65 +908,42 @@ elif menu == "Update / Delete Member":
 # -------------------------
 elif menu == "Attendance - Entry":
     st.header("Attendance — Entry (Face Verification)")
+    get_face_model()
     st.write("Capture live face to mark Entry. System ensures one row per person per day.")
     uploaded = st.camera_input("Capture Face for Entry")
 
     if uploaded is not None:
         try:
-            temp_path = "temp_entry.jpg"
-            Image.open(uploaded).convert("RGB").save(temp_path, format="JPEG", quality=90)
+            probe = decode_image(uploaded)
         except Exception as e:
             st.error(f"Failed to read camera image: {e}")
-            temp_path = None
+            probe = None
 
-        if temp_path:
+        if probe is not None:
             members = load_members()
             if members.empty:
                 st.warning("No registered members to match.")
             else:
-                best = None
-                best_dist = 1e9
-                progress = st.progress(0)
-                total = len(members)
-                for i, (_, row) in enumerate(members.iterrows(), 1):
-                    progress.progress(int(i/total*100))
-                    member_img = row.get("ImagePath","")
-                    if not member_img or not os.path.exists(member_img):
-                        continue
-                    match, distance, details = try_verify_faces(temp_path, member_img)
-                    if distance is None:
-                        # fallback boolean
-                        if match:
-                            best = (row, distance)
-                            break
-                    else:
-                        if distance < best_dist:
-                            best_dist = distance
-                            best = (row, distance)
-                        if distance <= DISTANCE_THRESHOLD:
-                            break
-                progress.empty()
+                with st.spinner("Matching face..."):
+                    best = match_face(probe, members)
 
                 if not best:
                     st.error("No matching member found in database.")
                 else:
                     row, dist = best
-                    is_match = (dist is not None and dist <= DISTANCE_THRESHOLD) or (dist is None and True)
+                    is_match = dist <= DISTANCE_THRESHOLD
                     if is_match:
                         attendance = load_attendance()
-                        now = datetime.now()
-                        today = now.strftime("%Y-%m-%d")
+                        today, now_time = now_date_time()
                         idstr = str(row["ID"])
                         exists = attendance[(attendance["ID"].astype(str) == idstr) & (attendance["Date"] == today)]
                         if not exists.empty:
                             st.warning(f"Entry already marked today for {row['Name']}.")
                         else:
-                            new_entry = {"ID": idstr, "Name": row["Name"], "Date": today, "EntryTime": now.strftime("%H:%M:%S"), "ExitTime": "", "Status": "Present"}
-                            attendance = pd.concat([attendance, pd.DataFrame([new_entry])], ignore_index=True)
-                            save_attendance(attendance)
+                            new_entry = {"ID": idstr, "Name": row["Name"], "Date": today, "EntryTime": now_time, "ExitTime": "", "Status": "Present"}
+                            append_attendance(new_entry)
                             st.success(f"Entry recorded for {row['Name']} at {new_entry['EntryTime']}")
-                            if dist is not None:
-                                st.write(f"Match distance: {dist:.4f}")
+                            st.write(f"Match distance: {dist:.4f}")
                     else:
                         st.error("Face did not match sufficiently. Try again or register.")
 
@@ -403,53 +952,33 @@ elif menu == "Attendance - Entry":
 # -------------------------
 elif menu == "Attendance - Exit":
     st.header("Attendance — Exit (Face Verification)")
+    get_face_model()
     st.write("Capture live face to mark Exit. This updates the same row (Entry + Exit).")
     uploaded = st.camera_input("Capture Face for Exit")
 
     if uploaded is not None:
         try:
-            temp_path = "temp_exit.jpg"
-            Image.open(uploaded).convert("RGB").save(temp_path, format="JPEG", quality=90)
+            probe = decode_image(uploaded)
         except Exception as e:
             st.error(f"Failed to read camera image: {e}")
-            temp_path = None
+            probe = None
 
-        if temp_path:
+        if probe is not None:
             members = load_members()
             if members.empty:
                 st.warning("No registered members to match.")
             else:
-                best = None
-                best_dist = 1e9
-                progress = st.progress(0)
-                total = len(members)
-                for i, (_, row) in enumerate(members.iterrows(), 1):
-                    progress.progress(int(i/total*100))
-                    member_img = row.get("ImagePath","")
-                    if not member_img or not os.path.exists(member_img):
-                        continue
-                    match, distance, details = try_verify_faces(temp_path, member_img)
-                    if distance is None:
-                        if match:
-                            best = (row, distance)
-                            break
-                    else:
-                        if distance < best_dist:
-                            best_dist = distance
-                            best = (row, distance)
-                        if distance <= DISTANCE_THRESHOLD:
-                            break
-                progress.empty()
+                with st.spinner("Matching face..."):
+                    best = match_face(probe, members)
 
                 if not best:
                     st.error("No matching member found in database.")
                 else:
                     row, dist = best
-                    is_match = (dist is not None and dist <= DISTANCE_THRESHOLD) or (dist is None and True)
+                    is_match = dist <= DISTANCE_THRESHOLD
                     if is_match:
                         attendance = load_attendance()
-                        now = datetime.now()
-                        today = now.strftime("%Y-%m-%d")
+                        today, now_time = now_date_time()
                         idstr = str(row["ID"])
                         mask = (attendance["ID"].astype(str) == idstr) & (attendance["Date"] == today)
                         open_rows = attendance[mask & ((attendance["ExitTime"].isna()) | (attendance["ExitTime"] == ""))]
@@ -457,12 +986,10 @@ elif menu == "Attendance - Exit":
                             st.warning("No open entry found for today. Please mark Entry first.")
                         else:
                             idx = open_rows.index[0]
-                            attendance.at[idx, "ExitTime"] = now.strftime("%H:%M:%S")
-                            attendance.at[idx, "Status"] = "Exited"
+                            attendance.loc[idx, ["ExitTime", "Status"]] = [now_time, "Exited"]
                             save_attendance(attendance)
-                            st.success(f"Exit recorded for {row['Name']} at {attendance.at[idx,'ExitTime']}")
-                            if dist is not None:
-                                st.write(f"Match distance: {dist:.4f}")
+                            st.success(f"Exit recorded for {row['Name']} at {now_time}")
+                            st.write(f"Match distance: {dist:.4f}")
                     else:
                         st.error("Face did not match sufficiently. Try again or register.")
 
@@ -471,65 +998,14 @@ elif menu == "Attendance - Exit":
 # -------------------------
 elif menu == "View Members":
     st.header("Members List")
-    members = load_members()
-    if members.empty:
-        st.warning("No members registered.")
-    else:
-        c1, c2, c3 = st.columns([1,1,1])
-        with c1:
-            id_filter = st.text_input("Filter by ID (exact)")
-        with c2:
-            name_filter = st.text_input("Search Name (partial)")
-        with c3:
-            phone_filter = st.text_input("Search Mobile (partial)")
-
-        df = members.copy()
-        if id_filter:
-            df = df[df["ID"].astype(str) == id_filter]
-        if name_filter:
-            df = df[df["Name"].str.contains(name_filter, case=False, na=False)]
-        if phone_filter:
-            df = df[df["Mobile"].str.contains(phone_filter, na=False)]
-
-        if df.empty:
-            st.info("No matching members.")
-        else:
-            st.dataframe(df)
-            csv = df.to_csv(index=False).encode("utf-8")
-            st.download_button("Download Members CSV", data=csv, file_name="members_filtered.csv", mime="text/csv")
+    view_members()
 
 # -------------------------
 # 6) View Attendance (filters)
 # -------------------------
 elif menu == "View Attendance":
     st.header("Attendance Log")
-    attendance = load_attendance()
-    if attendance.empty:
-        st.warning("No attendance records.")
-    else:
-        c1, c2, c3 = st.columns([1,1,1])
-        with c1:
-            date_filter = st.date_input("Filter by Date", value=None)
-            # To allow none, if user doesn't set date we treat as all
-        with c2:
-            id_filter = st.text_input("Filter by ID")
-        with c3:
-            name_filter = st.text_input("Filter by Name")
-
-        df = attendance.copy()
-        if date_filter:
-            df = df[df["Date"] == str(date_filter)]
-        if id_filter:
-            df = df[df["ID"].astype(str) == id_filter]
-        if name_filter:
-            df = df[df["Name"].str.contains(name_filter, case=False, na=False)]
-
-        if df.empty:
-            st.info("No matching attendance records.")
-        else:
-            st.dataframe(df)
-            csv = df.to_csv(index=False).encode("utf-8")
-            st.download_button("Download Attendance CSV", data=csv, file_name="attendance_filtered.csv", mime="text/csv")
+    view_attendance()
 
 # -------------------------
 # 7) Reset DB
@@ -539,13 +1015,15 @@ elif menu == "Reset DB":
     st.warning("This will permanently delete members, attendance, deleted members, images, and config.json")
     if st.button("Delete All Data (IRREVERSIBLE)"):
         try:
-            for f in [MEM_FILE, ATT_FILE, DELETED_FILE, CONFIG_FILE]:
-                if os.path.exists(f):
+            for f in [MEM_FILE, ATT_FILE, DELETED_FILE, CONFIG_FILE, EMB_FILE, EMB_SCALES_FILE, EMB_MANIFEST_FILE]:
+                if os.path.isdir(f):
+                    shutil.rmtree(f)
+                elif os.path.exists(f):
                     os.remove(f)
             if os.path.exists(IMG_DIR):
                 shutil.rmtree(IMG_DIR)
             os.makedirs(IMG_DIR, exist_ok=True)
-            ensure_csv_files()
-            st.success("All data removed and fresh CSVs created.")
+            ensure_data_files()
+            st.success("All data removed and fresh data files created.")
         except Exception as e:
             st.error(f"Failed to reset DB: {e}") 